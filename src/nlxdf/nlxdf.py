@@ -1,9 +1,9 @@
 """Main NlXdf class for processing Neurolive XDF data."""
 
-from collections import Counter
+from functools import cache
+from types import MappingProxyType
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 from pdxdf import Xdf
 from pdxdf.errors import NoLoadableStreamsError, XdfAlreadyLoadedError
@@ -11,14 +11,15 @@ from pdxdf.errors import NoLoadableStreamsError, XdfAlreadyLoadedError
 from nlxdf.plotting import format_load_params, format_title
 
 
-class NlXdf(Xdf):
-    """Main class for processing Neurolive XDF data.
+def _freeze_mapper(mapper):
+    """Return a read-only view of a {column: {old: new}} mapper."""
+    return MappingProxyType(
+        {col: MappingProxyType(mapping) for col, mapping in mapper.items()}
+    )
 
-    Provides a pandas-based layer of abstraction over raw XDF data with
-    customised Neurolive-specific pre-processing.
-    """
 
-    hostname_device_mapper = {
+_HOSTNAME_DEVICE_MAP = MappingProxyType(
+    {
         "DESKTOP-3R7C1PH": "eeg-a",
         "DESKTOP-2TI6RBU": "eeg-b",
         "DESKTOP-MN7K6RM": "eeg-c",
@@ -51,15 +52,19 @@ class NlXdf(Xdf):
         "cgs-macl-39034.campus.goldsmiths.ac.uk": "mirko",
         "kassia": "jamief",
     }
+)
 
-    metadata_mapper = {
+_METADATA_MAP = _freeze_mapper(
+    {
         "type": {
             "EEG": "eeg",
             #'marker': 'Timestamp',
         },
     }
+)
 
-    channel_metadata_mapper = {
+_CHANNEL_METADATA_MAP = _freeze_mapper(
+    {
         "label": {
             "0": "Fp1",
             "1": "Fpz",
@@ -108,6 +113,57 @@ class NlXdf(Xdf):
             "exg": "ecg",
         },
     }
+)
+
+
+@cache
+def _plot_rc():
+    """Return matplotlib rc settings shared by all plots."""
+    import matplotlib.pyplot as plt
+
+    return {"axes.prop_cycle": plt.cycler("color", plt.cm.tab20.colors)}
+
+
+def _decorate_axes(ax, title, df):
+    """Set plot title and annotate with load parameters."""
+    ax.set_title(format_title(title, df))
+    ax.text(
+        x=1.0,
+        y=1.0,
+        s=format_load_params(df),
+        fontsize=7,
+        transform=ax.transAxes,
+        horizontalalignment="left",
+        verticalalignment="bottom",
+    )
+
+
+def _map_values(df, mapper):
+    """Map values in place using a {column: {old: new}} mapper.
+
+    Values not in the column mapping are left unchanged.
+    """
+    for col, mapping in mapper.items():
+        if col not in df:
+            continue
+        # Map each distinct value once rather than every row.
+        codes, uniques = pd.factorize(df[col])
+        if uniques.isin(mapping.keys()).any():
+            mapped = uniques.map(lambda value: mapping.get(value, value)).to_numpy()
+            # Missing values (code -1) are left as they are.
+            df[col] = np.where(codes < 0, df[col], mapped[codes])
+
+
+class NlXdf(Xdf):
+    """Main class for processing Neurolive XDF data.
+
+    Provides a pandas-based layer of abstraction over raw XDF data with
+    customised Neurolive-specific pre-processing.
+    """
+
+    hostname_device_mapper = _HOSTNAME_DEVICE_MAP
+    metadata_mapper = _METADATA_MAP
+    channel_metadata_mapper = _CHANNEL_METADATA_MAP
 
     def resolve_streams(self, nl_id_as_index=True):
         """Resolve XDF streams from file using pyxdf.resolve_stream().
@@ -115,19 +171,18 @@ class NlXdf(Xdf):
         Apply custom device name mapping for Neurolive analysis.
         """
         df = super().resolve_streams()
+        # Lowercase types following MNE convention.
+        df["type"] = df["type"].str.lower()
         nl_ids = self._create_nl_ids(df)
-        df["nl_id"] = nl_ids
         if nl_id_as_index:
-            # Set nl_id as the index.
-            df.reset_index(inplace=True)
-            df.set_index("nl_id", inplace=True, verify_integrity=True)
-            df.sort_index(inplace=True)
+            # Set nl_id as the index, keeping stream_id as a column.
+            df.insert(0, "stream_id", df.index)
+            df = df.set_index(pd.Index(nl_ids, name="nl_id"), verify_integrity=True)
+            if not df.index.is_monotonic_increasing:
+                df = df.sort_index()
         else:
-            # Append nl_id as a new column.
-            cols = df.columns.tolist()
-            # Move nl_id to first column.
-            cols = cols[-1:] + cols[0:-1]
-            df = df[cols]
+            # Insert nl_id as the first column.
+            df.insert(0, "nl_id", nl_ids)
         return df
 
     def load(
@@ -161,15 +216,27 @@ class NlXdf(Xdf):
             return self
 
         # Map stream-IDs to neurolive IDs.
-        self._loaded_stream_ids = self._map_stream_ids(self.loaded_stream_ids)
-        self._desc = self._map_stream_ids(self._desc)
-        self._segments = self._map_stream_ids(self._segments)
-        self._clock_segments = self._map_stream_ids(self._clock_segments)
-        self._channel_info = self._map_stream_ids(self._channel_info)
-        self._footer = self._map_stream_ids(self._footer)
-        self._clock_offsets = self._map_stream_ids(self._clock_offsets)
-        self._time_series = self._map_stream_ids(self._time_series)
-        self._time_stamps = self._map_stream_ids(self._time_stamps)
+        (
+            self._loaded_stream_ids,
+            self._desc,
+            self._segments,
+            self._clock_segments,
+            self._channel_info,
+            self._footer,
+            self._clock_offsets,
+            self._time_series,
+            self._time_stamps,
+        ) = self._bulk_map_stream_ids(
+            self.loaded_stream_ids,
+            self._desc,
+            self._segments,
+            self._clock_segments,
+            self._channel_info,
+            self._footer,
+            self._clock_offsets,
+            self._time_series,
+            self._time_stamps,
+        )
 
         return self
 
@@ -194,21 +261,23 @@ class NlXdf(Xdf):
         # Lowercase types following MNE convention.
         df["type"] = df["type"].str.lower()
         # Fix-up metadata types.
-        df.replace(self.metadata_mapper, inplace=True)
+        _map_values(df, self.metadata_mapper)
+        # Few distinct values per file, so compare and map category codes.
+        for col in ["type", "hostname"]:
+            df[col] = df[col].astype("category")
         nl_ids = self._create_nl_ids(df)
-        df["nl_id"] = nl_ids
+        # Cache stream-id to nl_id lookup for mapping loaded data, in
+        # nl_id order so remapped payloads come out sorted.
+        self._stream_id_to_nl_id_map = nl_ids.sort_values().to_dict()
         if nl_id_as_index:
-            # Set nl_id as the index.
-            df.reset_index(inplace=True)
-            df.set_index("nl_id", inplace=True, verify_integrity=True)
-            df.index.rename("stream_id", inplace=True)
-            df.sort_index(inplace=True)
+            # Set nl_id as the index, keeping stream_id as a column.
+            df.insert(0, "stream_id", df.index)
+            df = df.set_index(pd.Index(nl_ids, name="stream_id"), verify_integrity=True)
+            if not df.index.is_monotonic_increasing:
+                df = df.sort_index()
         else:
-            # Append nl_id as a new column.
-            cols = df.columns.tolist()
-            # Move nl_id to first column.
-            cols = cols[-1:] + cols[0:-1]
-            df = df[cols]
+            # Insert nl_id as the first column.
+            df.insert(0, "nl_id", nl_ids)
         return df
 
     def _parse_channel_info(self, data, **kwargs):
@@ -221,107 +290,107 @@ class NlXdf(Xdf):
                 # For AntNeuro App which doesn't include channel labels.
                 if "index" in df and "label" not in df:
                     df["label"] = df["index"]
-                df.replace(self.channel_metadata_mapper, inplace=True)
+                _map_values(df, self.channel_metadata_mapper)
         return data
 
     def _create_nl_ids(self, df):
-        unique_id_counter = Counter()
-
-        def make_nl_id(row, unique_id_counter, hostname_map):
-            # Fallback to stream_id as string.
-            nl_id = str(row.name)
-
-            # EEG devices.
-            if row["type"].lower() == "eeg":
-                if row["hostname"] in hostname_map:
-                    # Map tablet hostname to eeg-* labels.
-                    nl_id = hostname_map[row["hostname"]]
-                else:
-                    # Unknown EEG device.
-                    nl_id = "eeg-?"
-
-            # Eye tracking.
-            elif row["name"].lower().startswith("pupil"):
-                # Map Pupil Labs device/streams.
-                if row["type"].lower() == "event":
-                    nl_id = f"pl-{row['source_id']}-event"
-                elif row["type"].lower() == "gaze":
-                    nl_id = f"pl-{row['source_id']}-gaze"
-
+        # Types are already lowercased by the caller.
+        stream_type = df["type"]
+        name = df["name"]
+        hostname = df["hostname"]
+        # Map tablet hostnames to eeg-* labels (NaN for unknown hosts),
+        # ignoring how hostnames are capitalised.
+        hostname_map = {
+            host.lower(): device
+            for host, device in self.hostname_device_mapper.items()
+        }
+        devices = hostname.str.lower().map(hostname_map)
+        # Fallback to stream_id as string.
+        stream_ids = df.index.astype(str).to_series(index=df.index)
+
+        # Eye tracking.
+        is_pupil = name.str.lower().str.startswith("pupil", na=False)
+        # Pupil Labs IDs (pl-<source_id>-<type>), built for pupil rows only.
+        pupil_ids = (
+            "pl-"
+            + df.loc[is_pupil, "source_id"].astype(str)
+            + "-"
+            + stream_type[is_pupil].astype(str)
+        ).reindex(df.index)
+        # Simulated sync test streams.
+        is_test = stream_type.eq("data") & name.str.startswith("Test", na=False)
+
+        # Priority-ordered (condition, nl_id) rules, first match wins.
+        rules = [
+            # EEG devices, unknown devices as eeg-?.
+            (stream_type.eq("eeg"), devices.fillna("eeg-?")),
+            # Map Pupil Labs device/streams.
+            (is_pupil & stream_type.isin(["event", "gaze"]), pupil_ids),
+            (is_pupil, stream_ids),
             # Marker streams.
-            elif row["name"] == "TABARNAK V3":
-                nl_id = "marker-ts"
-            elif row["name"] == "TimestampStream":
-                nl_id = "marker-ts"
-            elif row["name"] == "CameraRecordingTime":
-                nl_id = "marker-video"
-            elif row["name"] == "audio":
-                nl_id = "marker-audio"
-            elif row["name"] == "Keyboard_Marker_Stream":
-                nl_id = "marker-kb"
-            elif row["name"] == "FrameNumber_Stream":
-                nl_id = "marker-video"
-
-            # Simulated sync test streams.
-            elif row["type"] == "data" and row["name"].startswith("Test"):
-                if row["hostname"] in ["neurolive", "bobby"]:
-                    # Sync test running on the LabRecorder host -- the
-                    # closest thing we have to a ground truth with
-                    # simulated data.
-                    nl_id = "test-ref"
-                elif row["hostname"] in hostname_map:
-                    # Sync test running on an EEG tablet or known host.
-                    nl_id = f"test-{hostname_map[row['hostname']]}"
-                else:
-                    # Sync test running on another device.
-                    nl_id = "test"
-            elif row["type"] == "control":
-                # Simulated sync test control stream.
-                nl_id = "test-ctrl"
-
-            # Generic mappings.
-            elif row["type"].lower() == "markers":
-                # Catch-all marker stream mapper.
-                nl_id = "marker-" + nl_id
-            elif row["name"].startswith("_relay_"):
-                # Catch-all relayed streams.
-                nl_id = "relay-" + nl_id
-
-            # Automatically increment ID for duplicate stream IDs.
-            unique_id_counter.update([nl_id])
-            if unique_id_counter[nl_id] > 1:
-                nl_id = f"{nl_id}-{unique_id_counter[nl_id]}"
-            return nl_id
-
-        nl_ids = df.apply(
-            make_nl_id,
-            axis="columns",
-            unique_id_counter=unique_id_counter,
-            hostname_map=self.hostname_device_mapper,
+            (name.isin(["TABARNAK V3", "TimestampStream"]), "marker-ts"),
+            (name.isin(["CameraRecordingTime", "FrameNumber_Stream"]), "marker-video"),
+            (name.eq("audio"), "marker-audio"),
+            (name.eq("Keyboard_Marker_Stream"), "marker-kb"),
+            # Sync test running on the LabRecorder host -- the closest
+            # thing we have to a ground truth with simulated data.
+            (is_test & hostname.isin(["neurolive", "bobby"]), "test-ref"),
+            # Sync test running on an EEG tablet or known host.
+            (is_test & devices.notna(), "test-" + devices),
+            # Sync test running on another device.
+            (is_test, "test"),
+            # Simulated sync test control stream.
+            (stream_type.eq("control"), "test-ctrl"),
+            # Catch-all marker stream mapper.
+            (stream_type.eq("markers"), "marker-" + stream_ids),
+            # Catch-all relayed streams.
+            (name.str.startswith("_relay_", na=False), "relay-" + stream_ids),
+        ]
+        conditions, choices = zip(*rules)
+        nl_ids = pd.Series(
+            np.select(conditions, choices, default=stream_ids),
+            index=df.index,
         )
-        return nl_ids
 
-    def _map_stream_ids(self, data):
+        # Automatically increment ID for duplicate stream IDs.
+        count = nl_ids.groupby(nl_ids).cumcount()
+        return nl_ids.where(count == 0, nl_ids + "-" + (count + 1).astype(str))
+
+    def _bulk_map_stream_ids(self, *payloads):
+        """Map stream-IDs to neurolive IDs for several payloads at once."""
+        nl_id_map = self._stream_id_to_nl_id_map
+        return tuple(self._map_stream_ids(data, nl_id_map) for data in payloads)
+
+    def _map_stream_ids(self, data, nl_id_map=None):
         if data is None:
             return data
+        if isinstance(data, (list, dict)) and data:
+            if isinstance(next(iter(data)), str):
+                # Already mapped to nl_ids.
+                return data
+        if nl_id_map is None:
+            nl_id_map = self._stream_id_to_nl_id_map
+        if isinstance(data, (list, dict)):
+            missing = set(data) - nl_id_map.keys()
+            if missing:
+                raise KeyError(f"Unknown stream-ids: {sorted(missing)}")
         if isinstance(data, list):
-            data = [self._stream_id_to_nl_id(stream_id) for stream_id in data]
-            data.sort()
+            stream_ids = set(data)
+            data = [
+                nl_id
+                for stream_id, nl_id in nl_id_map.items()
+                if stream_id in stream_ids
+            ]
         elif isinstance(data, dict):
             data = {
-                self._stream_id_to_nl_id(stream_id): df
-                for stream_id, df in data.items()
+                nl_id: data[stream_id]
+                for stream_id, nl_id in nl_id_map.items()
+                if stream_id in data
             }
-            data = dict(sorted(data.items()))
         elif isinstance(data, pd.DataFrame):
-            data.rename(index=self._stream_id_to_nl_id, inplace=True)
-            data.sort_index(inplace=True)
+            data = data.rename(index=nl_id_map).sort_index()
         return data
 
-    def _stream_id_to_nl_id(self, stream_id):
-        nl_id = self._info.index[self._info["stream_id"] == stream_id][0]
-        return nl_id
-
     def plot_time_stamps(
         self,
         *stream_ids,
@@ -331,10 +400,11 @@ class NlXdf(Xdf):
         non_monotonic=False,
         downsample_non_monotonic=True,
     ):
+        import matplotlib as mpl
+        import matplotlib.pyplot as plt
+
         data = self.time_stamps(*stream_ids, exclude=exclude, with_stream_id=True)
-        with mpl.rc_context(
-            {"axes.prop_cycle": plt.cycler("color", plt.cm.tab20.colors)}
-        ):
+        with mpl.rc_context(_plot_rc()):
             n = len(data)
             if n > 1 and subplots:
                 fig, axes = plt.subplots(
@@ -367,26 +437,17 @@ class NlXdf(Xdf):
                     "time_stamp", "time_stamp", ax=ax, label=stream_id, s=1
                 )
                 ax.legend(bbox_to_anchor=(1, 1), loc=2)
-            title = format_title(title, ts)
-            axes[0].set_title(title)
-            axes[0].text(
-                x=1.0,
-                y=1.0,
-                s=format_load_params(ts),
-                fontsize=7,
-                transform=axes[0].transAxes,
-                horizontalalignment="left",
-                verticalalignment="bottom",
-            )
+            _decorate_axes(axes[0], title, ts)
         return axes
 
     def plot_data(
         self, *stream_ids, exclude=[], cols=None, title="XDF data", subplots=False
     ):
+        import matplotlib as mpl
+        import matplotlib.pyplot as plt
+
         data = self.data(*stream_ids, exclude=exclude, cols=cols, with_stream_id=True)
-        with mpl.rc_context(
-            {"axes.prop_cycle": plt.cycler("color", plt.cm.tab20.colors)}
-        ):
+        with mpl.rc_context(_plot_rc()):
             n = len(data)
             if n > 1 and subplots:
                 fig, axes = plt.subplots(
@@ -405,20 +466,20 @@ class NlXdf(Xdf):
                     *stream_ids, exclude=exclude, with_stream_id=True
                 ).values(),
             ):
-                df = pd.concat({stream_id: df}, axis=1)
                 ax = axes[i % len(axes)]
+                time_stamps = df.index.get_level_values("time_stamp")
                 for (seg_start, seg_end) in segments:
                     # Plot start of segments.
                     if subplots or i == 0:
                         ax.axvline(
-                            df.index.get_level_values("time_stamp")[seg_start],
+                            time_stamps[seg_start],
                             color=plt.cm.tab20.colors[2],
                             alpha=0.5,
                             label="segments",
                         )
                     else:
                         ax.axvline(
-                            df.index.get_level_values("time_stamp")[seg_start],
+                            time_stamps[seg_start],
                             color=plt.cm.tab20.colors[2],
                             alpha=0.5,
                         )
@@ -426,33 +487,37 @@ class NlXdf(Xdf):
                     # Plot end of clock segments.
                     if subplots or i == 0:
                         ax.axvline(
-                            df.index.get_level_values("time_stamp")[c_seg_end],
+                            time_stamps[c_seg_end],
                             color=plt.cm.tab20.colors[6],
                             alpha=0.5,
                             label="clock segments",
                         )
                     else:
                         ax.axvline(
-                            df.index.get_level_values("time_stamp")[c_seg_end],
+                            time_stamps[c_seg_end],
                             color=plt.cm.tab20.colors[6],
                             alpha=0.5,
                         )
-                df.droplevel(["segment", "sample"]).plot(ax=ax)
+                df = df.droplevel(["segment", "sample"])
+                # Label columns by stream-id for the legend.
+                cols = df.columns
+                df.columns = pd.MultiIndex.from_arrays(
+                    [
+                        [stream_id] * len(cols),
+                        *(cols.get_level_values(i) for i in range(cols.nlevels)),
+                    ],
+                    names=[None, *cols.names],
+                )
+                df.plot(ax=ax)
                 ax.legend(bbox_to_anchor=(1, 1), loc=2)
-            title = format_title(title, df)
-            axes[0].set_title(title)
-            axes[0].text(
-                x=1.0,
-                y=1.0,
-                s=format_load_params(df),
-                fontsize=7,
-                transform=axes[0].transAxes,
-                horizontalalignment="left",
-                verticalalignment="bottom",
-            )
+            if data:
+                # Load parameters are shared by all streams.
+                _decorate_axes(axes[0], title, next(iter(data.values())))
         return axes
 
     def plot_data_box(self, *stream_ids, exclude=[], cols=None, title="XDF data"):
+        import matplotlib as mpl
+
         if cols is not None and not isinstance(cols, list):
             cols = [cols]
         df = self.data(
@@ -462,21 +527,9 @@ class NlXdf(Xdf):
             with_stream_id=True,
             concat=True,
         )
-        with mpl.rc_context(
-            {"axes.prop_cycle": plt.cycler("color", plt.cm.tab20.colors)}
-        ):
+        with mpl.rc_context(_plot_rc()):
             axes = df.groupby("stream_id").plot.box(vert=False)
-            title = format_title(title, df)
             for ax in axes:
-                ax.set_title(title)
-                ax.text(
-                    x=1.0,
-                    y=1.0,
-                    s=format_load_params(df),
-                    fontsize=7,
-                    transform=ax.transAxes,
-                    horizontalalignment="left",
-                    verticalalignment="bottom",
-                )
+                _decorate_axes(ax, title, df)
                 ax.set_xlabel("value")
         return axes
@@ -1,6 +1,5 @@
 import textwrap
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 
@@ -79,6 +78,8 @@ def plot_sample_counts_df(df):
 
 # FIXME by segment?
 def plot_time_stamp_intervals_df(s, units="milliseconds", showfliers=True):
+    import matplotlib.pyplot as plt
+
     df = s.to_frame()
     df = scale_seconds(df, units)
     n = df.index.levels[0].size
@@ -110,6 +111,8 @@ def plot_time_stamp_intervals_df(s, units="milliseconds", showfliers=True):
 
 
 def plot_first_time_stamps_df(df, units="seconds"):
+    import matplotlib.pyplot as plt
+
     df = scale_seconds(df, units)
     earliest = df["first_timestamp"].groupby(level=0, sort=False).min()
     df = df["first_timestamp"] - earliest
@@ -170,6 +173,8 @@ def plot_first_time_stamps_dist_df(df, units="seconds"):
 
 
 def plot_clock_offsets(data, normalise=False):
+    import matplotlib.pyplot as plt
+
     n = len(data)
     cols = 2
     rows = np.ceil(n / cols).astype(int)